@@ -3,39 +3,44 @@ import pathlib
 import time
 
 import requests
-import re
+from requests.adapters import HTTPAdapter
 import argparse
-from typing import List, Dict, Set, Optional
+from operator import itemgetter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from typing import List, Dict, Iterable, Set, Optional
 from datetime import datetime, timedelta
 
 
-# Match QCI sha tags like "20240603235401_prune_ci_a_latest"
-prune_tag_match = re.compile(r"^(?P<year>\d\d\d\d)(?P<month>\d\d)(?P<day>\d\d)(?P<hour>\d\d)(?P<minute>\d\d)(?P<second>\d\d)_prune_(?P<ci_tag>.+)$")
+# Maximum number of tag deletes to have in flight against quay.io at once
+DELETE_WORKERS = 10
 
+# Maximum number of tag deletes to have submitted but not yet reported on. Keeping this small
+# means little is left queued when a run fails or is interrupted.
+MAX_PENDING_DELETES = DELETE_WORKERS * 4
 
-def delete_tag(repository: str, tag: str, token: str):
+# Maximum number of per-tag result lines to collect before writing them out together
+OUTPUT_BATCH = 500
+
+# Shared by all requests (and worker threads) so connections to quay.io are kept alive and reused
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_maxsize=32))
+
+
+def delete_tag(repository: str, tag: str):
     """Delete a tag from a Quay.io repository"""
     delete_url = f"https://quay.io/api/v1/repository/{repository}/tag/{tag}"
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
-    response = requests.delete(delete_url, headers=headers)
-    if response.status_code == 204:
-        print(f"Tag '{tag}' deleted successfully")
-    else:
-        print(f"Failed to delete tag '{tag}': {response.status_code} {response.text}")
+    response = SESSION.delete(delete_url)
+    if response.status_code != 204:
+        raise IOError(f"Failed to delete tag: {response.status_code} {response.text}")
 
 
-def fetch_tags(repository: str, token: str, page: int = 1, like: Optional[str] = None):
+def fetch_tags(repository: str, page: int = 1, like: Optional[str] = None):
     """Fetch tags from the Quay.io repository with pagination"""
     like_adder = ''
     if like:
         like_adder = f'&filter_tag_name=like:{like}'
     tags_url = f"https://quay.io/api/v1/repository/{repository}/tag/?page={page}&limit=100&onlyActiveTags=true" + like_adder
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
-    response = requests.get(tags_url, headers=headers)
+    response = SESSION.get(tags_url)
     if response.status_code == 200:
         data = response.json()
         tags = data.get("tags", [])
@@ -45,6 +50,51 @@ def fetch_tags(repository: str, token: str, page: int = 1, like: Optional[str] =
         raise IOError(f"Failed to fetch tags: {response.status_code} {response.text}")
 
 
+def is_prune_tag(image_tag: str) -> bool:
+    """Return whether image_tag is a QCI prune tag (YYYYMMDDHHMMSS_prune_<ci tag>)"""
+    # QCI prune tags look like "20240603235401_prune_ci_a_latest"
+    # QCI tags have a fixed layout, so a few string operations classify them without a regex
+    return len(image_tag) > 21 and image_tag[14:21] == '_prune_' and image_tag[:14].isdecimal()
+
+
+def find_prune_targets(tags: List[Dict], cutoff: int, prune_target_tags: Set[str]) -> List[str]:
+    """Return the names of not yet seen tags matching "YYMMDDHHMMSS_prune_%" dated before cutoff (YYYYMMDD)"""
+    # Classify the whole page in one comprehension. Tag names within a page are unique, but the
+    # pages are offset based and tags pushed mid-scan shift later pages, so a tag can come back
+    # on a later page. The membership test is last so it only costs a hash for actual targets.
+    page_target_tags = [
+        image_tag for image_tag in map(itemgetter('name'), tags)
+        if is_prune_tag(image_tag) and int(image_tag[:8]) < cutoff and image_tag not in prune_target_tags
+    ]
+    prune_target_tags.update(page_target_tags)
+    return page_target_tags
+
+
+def flush_removed(removed: List[str]):
+    """Write out, and clear, buffered "Removed" lines"""
+    if removed:
+        print('\n'.join(removed), flush=True)
+        removed.clear()
+
+
+def report_deletes(pending_deletes: Dict[Future, str], pruned_tags: Set[str], done: Iterable[Future],
+                   removed: List[str]):
+    """Report on, and stop tracking, the completed tag deletes in done, buffering success lines in removed"""
+    for future in done:
+        image_tag = pending_deletes.pop(future)
+        try:
+            future.result()
+        except Exception as e:
+            # Failures are not batched so they show up straight away, after what came before them
+            flush_removed(removed)
+            print(f'Error while trying to delete tag {image_tag}: {e}', flush=True)
+            continue
+        pruned_tags.add(image_tag)
+        removed.append(f'Removed {image_tag}')
+        if len(removed) >= OUTPUT_BATCH:
+            flush_removed(removed)
+
+
 if __name__ == '__main__':
     start_time = datetime.now()
     parser = argparse.ArgumentParser(description="Process some optional arguments.")
@@ -57,9 +107,13 @@ if __name__ == '__main__':
     if not args.token:
         print('OAuth token is required')
         exit(1)
-    token = args.token
+    SESSION.headers['Authorization'] = f'Bearer {args.token}'
     confirm = args.confirm
 
+    # Tags dated more than 5 whole days before today are pruned. Comparing YYYYMMDD ints keeps
+    # datetime arithmetic out of the per-tag loop.
+    cutoff = int((start_time - timedelta(days=5)).strftime('%Y%m%d'))
+
     # Fetch all tags with pagination
     page = 1
     has_more = True
@@ -68,51 +122,55 @@ if __name__ == '__main__':
     pruned_tags = set()
     tag_count = 0
     mod_by = 5
-    while has_more:
-        retries = 3
-        while retries > 0:
-            try:
-                tags, has_more = fetch_tags('openshift/ci', token, page, like='_prune_')
-                break
-            except Exception as e:
-                print(f'Error retrieving tags: {e}')
-                if retries == 0:
-                    raise
-                print('Retrying in 1 minute..')
-                time.sleep(60)
-                retries -= 1
-
-        # Iterate through tags and delete those that match the pattern "YYMMDDHHMMSS_prune_%"
-        for tag in tags:
-            tag_count += 1
-            image_tag = tag['name']
-
-            if tag_count % mod_by == 0:
+    # Deletes are latency bound, so keep several in flight at once, and keep them going while
+    # later pages are fetched. Results are collected in the main thread so the bookkeeping
+    # needs no locking.
+    pending_deletes: Dict[Future, str] = dict()
+    removed: List[str] = []  # "Removed" lines waiting to be written out, across the whole run
+    delete_executor = ThreadPoolExecutor(max_workers=DELETE_WORKERS)
+    try:
+        while has_more:
+            retries = 3
+            while True:
+                try:
+                    tags, has_more = fetch_tags('openshift/ci', page, like='_prune_')
+                    break
+                except Exception as e:
+                    print(f'Error retrieving tags: {e}')
+                    retries -= 1
+                    if retries == 0:
+                        raise
+                    print('Retrying in 1 minute..')
+                    time.sleep(60)
+
+            page_tag_count = tag_count
+            tag_count += len(tags)
+            if tag_count // mod_by > page_tag_count // mod_by:
                 mod_by = min(mod_by * 2, 1000)
                 print(f'{tag_count} tags have been checked')
 
-            match = prune_tag_match.match(image_tag)
-            if match:
-                year = int(match.group('year'))
-                month = int(match.group('month'))
-                day = int(match.group('day'))
-                prune_tag_date = datetime(year, month, day)
-
-                date_difference = start_time - prune_tag_date
-                days_difference = date_difference.days
-                if days_difference > 5 and image_tag not in prune_target_tags:
-                    prune_target_tags.add(image_tag)
-                    if confirm:
-                        try:
-                            delete_tag('openshift/ci', tag=image_tag, token=token)
-                            print(f'Removed {image_tag}')
-                            pruned_tags.add(image_tag)
-                        except Exception as e:
-                            print(f'Error while trying to delete tag {image_tag}: {e}')
-                    else:
-                        print(f'Would have removed {image_tag}')
-
-        page += 1
+            page_target_tags = find_prune_targets(tags, cutoff, prune_target_tags)
+            if confirm:
+                for image_tag in page_target_tags:
+                    if len(pending_deletes) >= MAX_PENDING_DELETES:
+                        done, _ = wait(pending_deletes, return_when=FIRST_COMPLETED)
+                        report_deletes(pending_deletes, pruned_tags, done, removed)
+                    future = delete_executor.submit(delete_tag, 'openshift/ci', tag=image_tag)
+                    pending_deletes[future] = image_tag
+            elif page_target_tags:
+                print('\n'.join(f'Would have removed {image_tag}' for image_tag in page_target_tags))
+
+            page += 1
+
+        report_deletes(pending_deletes, pruned_tags, as_completed(list(pending_deletes)), removed)
+        flush_removed(removed)
+    except BaseException:
+        flush_removed(removed)
+        # Stop deleting as soon as the run fails or is interrupted; only the deletes already
+        # being sent are allowed to finish.
+        delete_executor.shutdown(cancel_futures=True)
+        raise
+    delete_executor.shutdown()
 
     finish_time = datetime.now()
     print(f'Duration: {finish_time - start_time}')